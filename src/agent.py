@@ -1,95 +1,447 @@
 """Web Research Agent — Deep Agents-powered research agent with web search."""
 
-import json
+import asyncio
+import hashlib
+import io
 import os
 import sys
-from datetime import datetime
+import time
+from collections import OrderedDict, deque
+from contextlib import aclosing
+from contextvars import ContextVar
+from datetime import datetime, time as dt_time, timedelta
+from functools import lru_cache
 
 import httpx
+import orjson
 from deepagents import create_deep_agent
 from langchain.chat_models import init_chat_model
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage
 from langchain_core.tools import tool
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
 BRAVE_API_KEY = os.environ.get("BRAVE_API_KEY", "")
 BRAVE_BASE_URL = os.environ.get("BRAVE_BASE_URL", "https://api.search.brave.com")
 BRAVE_SEARCH_URL = f"{BRAVE_BASE_URL}/res/v1/web/search"
 
+# Shared client so repeated searches reuse a warm keep-alive connection, and
+# concurrent searches multiplex over a single HTTP/2 socket.
+_CLIENT = httpx.AsyncClient(
+    http2=True,
+    timeout=15,
+    limits=httpx.Limits(max_keepalive_connections=32),
+    headers={
+        "Accept": "application/json",
+        "X-Subscription-Token": BRAVE_API_KEY,
+    },
+)
+
+# Search URL with the fixed query parameters pre-encoded; only ``q`` is added
+# per call.
+_SEARCH_URL = httpx.URL(BRAVE_SEARCH_URL, params={"count": 10})
+
+# Upper bound on research requests handled concurrently.
+_MAX_CONCURRENT_REQUESTS = 8
+_SEM = asyncio.Semaphore(_MAX_CONCURRENT_REQUESTS)
+
+# Per-request budget for the agent loop, subagents included: model turns,
+# cumulative response tokens, and searches that repeat an earlier query's
+# fingerprint. See _Budget.
+_MAX_TURNS = 8
+_MAX_OUTPUT_TOKENS = 16_000
+_MAX_DUPLICATE_SEARCHES = 2
+
+# Recent search results keyed by normalized query: (stored_at, result).
+_CACHE: OrderedDict[str, tuple[float, str]] = OrderedDict()
+_CACHE_TTL = 300
+_CACHE_MAX_ENTRIES = 256
+
+# Transient Brave failures are retried with backoff; once more than
+# _BREAKER_THRESHOLD searches fail within _BREAKER_WINDOW seconds, searches
+# short-circuit so the model can stop instead of looping on errors.
+_RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+_MAX_RETRY_AFTER = 5.0
+_BREAKER_THRESHOLD = 5
+_BREAKER_WINDOW = 30
+_failures: deque[float] = deque()
+
+# message_id of the request a tool call belongs to, so tools can report progress.
+_current_message_id: ContextVar[str | None] = ContextVar("current_message_id", default=None)
+
+# Per-request map of query fingerprint -> result, so paraphrased repeats of a
+# search within one research run skip the Brave call.
+_run_cache: ContextVar[dict[str, str] | None] = ContextVar("run_cache", default=None)
+
+# Budget of the request a tool call belongs to; see _Budget.
+_run_budget: ContextVar["_Budget | None"] = ContextVar("run_budget", default=None)
+
+_STOPWORDS = frozenset({
+    "a", "an", "and", "are", "at", "by", "for", "from", "how", "in", "is",
+    "it", "of", "on", "or", "the", "to", "was", "what", "when", "where",
+    "which", "who", "why", "with",
+})
+
+# Formatted date for the system prompt and the local time it stops being valid.
+_date_cache: tuple[float, str] = (0.0, "")
+
+# Buffered writer for the protocol stream, opened by main(); see _writer().
+_OUT: io.BufferedWriter | None = None
+_flush_pending = False
+
+
+def _writer():
+    return _OUT if _OUT is not None else sys.stdout.buffer
+
+
+def _flush() -> None:
+    global _flush_pending
+    _flush_pending = False
+    _writer().flush()
+
 
 def send(msg: dict) -> None:
-    sys.stdout.write(json.dumps(msg) + "\n")
-    sys.stdout.flush()
+    """Write one JSON line to stdout.
+
+    Inside the event loop the flush is deferred to the next loop iteration, so
+    messages sent back-to-back (e.g. streamed chunks) share a single write.
+    """
+    global _flush_pending
+    out = _writer()
+    out.write(orjson.dumps(msg) + b"\n")
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        out.flush()
+        return
+    if not _flush_pending:
+        _flush_pending = True
+        loop.call_soon(_flush)
 
 
 def log(text: str) -> None:
     print(text, file=sys.stderr, flush=True)
 
 
+def _fingerprint(query: str) -> str:
+    """Order- and stopword-insensitive key for a search query."""
+    words = sorted(w for w in query.lower().split() if w not in _STOPWORDS)
+    return hashlib.md5(" ".join(words).encode()).hexdigest()
+
+
+class _Budget:
+    """Usage of one research request, across the main agent and its subagents.
+
+    Model turns and response tokens are counted by _BudgetCallback, which sees
+    every LLM run under the request's config, and searches are recorded by
+    web_search itself, so a ``task`` subagent cannot run past the limits.
+    """
+
+    def __init__(self) -> None:
+        self.turns = 0
+        self.output_tokens = 0
+        self.duplicates = 0
+        self._queries: set[str] = set()
+
+    def record_search(self, query: str) -> None:
+        fingerprint = _fingerprint(query)
+        if fingerprint in self._queries:
+            self.duplicates += 1
+        self._queries.add(fingerprint)
+
+    def exhausted(self) -> str | None:
+        """Why the budget is spent, or None while there is budget left."""
+        if self.turns >= _MAX_TURNS:
+            return f"reached the limit of {_MAX_TURNS} model turns"
+        if self.output_tokens > _MAX_OUTPUT_TOKENS:
+            return f"used over {_MAX_OUTPUT_TOKENS} response tokens"
+        if self.duplicates > _MAX_DUPLICATE_SEARCHES:
+            return "kept repeating earlier searches"
+        return None
+
+
+class _BudgetCallback(BaseCallbackHandler):
+    """Counts every model call of a request against its _Budget."""
+
+    run_inline = True
+
+    def __init__(self, budget: _Budget) -> None:
+        self.budget = budget
+
+    def on_llm_end(self, response, **kwargs) -> None:
+        self.budget.turns += 1
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                self.budget.output_tokens += (usage or {}).get("output_tokens", 0)
+
+
+def _report_search(description: str) -> None:
+    """Emit a web_search activity event for the current request."""
+    message_id = _current_message_id.get()
+    if message_id is None:
+        return
+    send({
+        "type": "activity",
+        "tool": "web_search",
+        "description": description,
+        "message_id": message_id,
+    })
+
+
+def _report_done(query: str, outcome: str) -> None:
+    """Emit an activity event as soon as an individual search finishes."""
+    _report_search(f"{outcome}: {query}")
+
+
+def _is_transient(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.TimeoutException):
+        return True
+    return (
+        isinstance(exc, httpx.HTTPStatusError)
+        and exc.response.status_code in _RETRYABLE_STATUS
+    )
+
+
+_backoff = wait_exponential_jitter(initial=0.1, max=1.0)
+
+
+def _retry_wait(retry_state) -> float:
+    """Honor Retry-After on 429s, otherwise back off exponentially with jitter."""
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 429:
+        try:
+            return min(float(exc.response.headers["Retry-After"]), _MAX_RETRY_AFTER)
+        except (KeyError, ValueError):
+            pass
+    return _backoff(retry_state)
+
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=_retry_wait,
+    retry=retry_if_exception(_is_transient),
+    reraise=True,
+)
+async def _brave_get(query: str) -> httpx.Response:
+    request = _CLIENT.build_request("GET", _SEARCH_URL.copy_merge_params({"q": query}))
+    resp = await _CLIENT.send(request)
+    resp.raise_for_status()
+    return resp
+
+
+def _breaker_open() -> bool:
+    cutoff = time.monotonic() - _BREAKER_WINDOW
+    while _failures and _failures[0] < cutoff:
+        _failures.popleft()
+    return len(_failures) > _BREAKER_THRESHOLD
+
+
 @tool
-def web_search(query: str) -> str:
+async def web_search(query: str) -> str:
     """Search the web for real-time information. Use this to find current facts, news, documentation, or any topic the user asks about. You can call this multiple times with different queries to get broader coverage."""
+    # Searches announce themselves, so ones made inside subagents get a start
+    # event to match their completion event too.
+    _report_search(f"web_search({query})")
+
+    budget = _run_budget.get()
+    if budget is not None:
+        if reason := budget.exhausted():
+            _report_done(query, "Skipped")
+            return f"Search skipped: the research budget is spent ({reason}). Answer from the results you already have."
+        budget.record_search(query)
+
+    run_cache = _run_cache.get()
+    fingerprint = _fingerprint(query)
+    if run_cache is not None and fingerprint in run_cache:
+        log(f"Duplicate search in this run: {query}")
+        _report_done(query, "Analyzing results")
+        return run_cache[fingerprint]
+
+    key = query.strip().lower()
+    cached = _CACHE.get(key)
+    if cached is not None and time.monotonic() - cached[0] < _CACHE_TTL:
+        _CACHE.move_to_end(key)
+        log(f"Cache hit for: {query}")
+        _report_done(query, "Analyzing results")
+        if run_cache is not None:
+            run_cache[fingerprint] = cached[1]
+        return cached[1]
+
+    if _breaker_open():
+        _report_done(query, "Search unavailable")
+        return "Search error: Brave Search is temporarily unavailable. Answer with what you have or try again later."
+
     try:
-        resp = httpx.get(
-            BRAVE_SEARCH_URL,
-            params={"q": query, "count": 10},
-            headers={
-                "Accept": "application/json",
-                "X-Subscription-Token": BRAVE_API_KEY,
-            },
-            timeout=15,
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        log(f"Brave API returned {len(data.get('web', {}).get('results', []))} results for: {query}")
-        results = []
-        for item in data.get("web", {}).get("results", []):
-            results.append(
-                f"Title: {item.get('title', '')}\n"
-                f"URL: {item.get('url', '')}\n"
-                f"Description: {item.get('description', '')}"
-            )
-        if not results:
+        resp = await _brave_get(query)
+        items = orjson.loads(resp.content).get("web", {}).get("results", ())
+        log(f"Brave API returned {len(items)} results for: {query}")
+        if not items:
+            _report_done(query, "No results")
             return "No results found. Try a different search query."
-        return "\n\n---\n\n".join(results)
+        result = "\n\n---\n\n".join(
+            f"Title: {item.get('title', '')}\n"
+            f"URL: {item.get('url', '')}\n"
+            f"Description: {item.get('description', '')}"
+            for item in items
+        )
     except Exception as e:
+        _failures.append(time.monotonic())
+        _report_done(query, "Search failed")
         return f"Search error: {e}"
 
+    _failures.clear()
+    _report_done(query, "Analyzing results")
+    if run_cache is not None:
+        run_cache[fingerprint] = result
+    _CACHE[key] = (time.monotonic(), result)
+    _CACHE.move_to_end(key)
+    if len(_CACHE) > _CACHE_MAX_ENTRIES:
+        _CACHE.popitem(last=False)
+    return result
+
+
+_TURN_SEPARATOR = "\n\n---\n\n"
+
+
+def _text_delta(content) -> str:
+    """Extract the text portion of a streamed message chunk's content."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(
+            block.get("text", "")
+            for block in content
+            if isinstance(block, dict) and block.get("type") == "text"
+        )
+    return ""
+
+
+def _today() -> str:
+    """Today's date for the system prompt, recomputed only after local midnight."""
+    global _date_cache
+    if time.time() >= _date_cache[0]:
+        now = datetime.now()
+        midnight = datetime.combine(now.date() + timedelta(days=1), dt_time.min)
+        _date_cache = (midnight.timestamp(), now.strftime("%B %d, %Y"))
+    return _date_cache[1]
+
+
+@lru_cache(maxsize=1)
+def _chat_model():
+    return init_chat_model("anthropic:claude-sonnet-4-5-20250929")
+
+
+def _system_prompt(today: str) -> str:
+    return (
+        f"You are Web Research Agent, an expert research assistant. Today is {today}. "
+        "Your job is to thoroughly research the user's question using web search. "
+        "Strategy:\n"
+        "1. Break complex questions into sub-queries and search for each\n"
+        "2. Search multiple times with different angles to get comprehensive coverage\n"
+        "3. For simple greetings or non-research questions, just respond naturally without searching\n"
+        "4. Synthesize all findings into a clear, well-structured briefing with markdown\n"
+        "5. Include inline citations [1], [2] etc. and end with a Sources section\n"
+        "Be thorough but concise. Prioritize accuracy and recency."
+    )
+
 
-def research(query: str, message_id: str) -> str:
-    """Run the Deep Agent to research a topic."""
-    today = datetime.now().strftime("%B %d, %Y")
+@lru_cache(maxsize=1)
+def _build_agent(today: str):
+    """Build the Deep Agent, reused across requests until the date changes.
 
-    agent = create_deep_agent(
-        model=init_chat_model("anthropic:claude-sonnet-4-5-20250929"),
+    create_deep_agent installs Anthropic prompt caching middleware, which marks
+    the request prefix (system prompt, tools and prior turns, including tool
+    results) with ``cache_control``; keep the prompt text stable so every turn
+    of the loop hits that cache.
+    """
+    return create_deep_agent(
+        model=_chat_model(),
         tools=[web_search],
-        system_prompt=(
-            f"You are Web Research Agent, an expert research assistant. Today is {today}. "
-            "Your job is to thoroughly research the user's question using web search. "
-            "Strategy:\n"
-            "1. Break complex questions into sub-queries and search for each\n"
-            "2. Search multiple times with different angles to get comprehensive coverage\n"
-            "3. For simple greetings or non-research questions, just respond naturally without searching\n"
-            "4. Synthesize all findings into a clear, well-structured briefing with markdown\n"
-            "5. Include inline citations [1], [2] etc. and end with a Sources section\n"
-            "Be thorough but concise. Prioritize accuracy and recency."
-        ),
+        system_prompt=_system_prompt(today),
     )
 
-    final_response = ""
+
+def _synthesis_messages(today: str, history: list, reason: str) -> list:
+    """Messages for a final, tool-free answer once the research budget is spent.
+
+    Tool calls and results are flattened to plain text so the request needs no
+    tool definitions and the model cannot search again.
+    """
+    messages = [SystemMessage(_system_prompt(today))]
+    for msg in history:
+        text = _text_delta(msg.content)
+        if msg.type == "human":
+            messages.append(HumanMessage(text))
+        elif msg.type == "ai" and text:
+            messages.append(AIMessage(text))
+        elif msg.type == "tool":
+            messages.append(HumanMessage(f"[{msg.name or 'tool'} result]\n{text}"))
+    messages.append(HumanMessage(
+        f"Research has stopped because it {reason}. Do not search further: answer "
+        "the original question now from the results gathered above."
+    ))
+    return messages
+
+
+async def research(query: str, message_id: str) -> None:
+    """Run the Deep Agent to research a topic.
+
+    Runs on the async graph so that multiple tool calls emitted in a single
+    model turn are executed concurrently by the tool node. Response text is
+    streamed to the client as it is generated; the caller sends the final
+    ``done`` message. If the run exceeds its budget, the pending tool calls
+    are dropped and the model answers from the results gathered so far.
+    """
+    today = _today()
+    agent = _build_agent(today)
+    _current_message_id.set(message_id)
+    _run_cache.set({})
+    budget = _Budget()
+    _run_budget.set(budget)
+
     _emitted_tool_calls: set[str] = set()
+    streamed_turn: str | None = None
+    reason: str | None = None
 
-    for event in agent.stream(
+    async with aclosing(agent.astream(
         {"messages": [{"role": "user", "content": query}]},
-        stream_mode="values",
-    ):
-        if not isinstance(event, dict) or "messages" not in event:
-            continue
+        stream_mode=["messages", "values"],
+        config={"callbacks": [_BudgetCallback(budget)]},
+    )) as stream:
+        async for mode, event in stream:
+            if mode == "messages":
+                chunk, metadata = event
+                # Only stream the model node's text, not LLM calls made by
+                # middleware in other nodes. Subagent tokens never get here:
+                # LangGraph drops subgraph messages unless subgraphs=True.
+                if metadata.get("langgraph_node") != "model":
+                    continue
+                if not isinstance(chunk, AIMessageChunk):
+                    continue
+                delta = _text_delta(chunk.content)
+                if not delta:
+                    continue
+                # Text from earlier tool-calling turns has already been sent;
+                # separate each new turn so the answer doesn't run into it.
+                if chunk.id != streamed_turn:
+                    if streamed_turn is not None:
+                        delta = _TURN_SEPARATOR + delta
+                    streamed_turn = chunk.id
+                send({
+                    "type": "response",
+                    "content": delta,
+                    "message_id": message_id,
+                    "done": False,
+                })
+                continue
+
+            if not isinstance(event, dict) or "messages" not in event:
+                continue
 
-        for msg in event["messages"]:
-            if (
-                getattr(msg, "type", None) == "ai"
-                and hasattr(msg, "tool_calls")
-                and msg.tool_calls
-            ):
+            for msg in event["messages"]:
+                if getattr(msg, "type", None) != "ai":
+                    continue
                 for tc in msg.tool_calls:
                     tc_id = tc.get("id") or tc.get("name", "")
                     if tc_id in _emitted_tool_calls:
@@ -98,6 +450,8 @@ def research(query: str, message_id: str) -> str:
                     tool_name = tc.get("name", "unknown")
                     tool_args = tc.get("args", {})
                     q = tool_args.get("query", "")
+                    if tool_name == "web_search":
+                        continue  # Announced by web_search itself.
                     desc = f"{tool_name}({q})" if q else tool_name
                     send({
                         "type": "activity",
@@ -106,36 +460,104 @@ def research(query: str, message_id: str) -> str:
                         "message_id": message_id,
                     })
 
-        for msg in reversed(event["messages"]):
-            if getattr(msg, "type", None) != "ai":
+            # Only cut the run short while the agent still wants to keep going.
+            last = event["messages"][-1] if event["messages"] else None
+            if getattr(last, "type", None) != "ai" or not last.tool_calls:
                 continue
-            msg_content = getattr(msg, "content", "")
-            if isinstance(msg_content, str) and msg_content.strip():
-                final_response = msg_content
-                break
-            elif isinstance(msg_content, list):
-                for block in msg_content:
-                    if isinstance(block, dict) and block.get("type") == "text":
-                        final_response = block.get("text", "")
-                        break
-                if final_response:
-                    break
-
-    return final_response
-
-
-def main():
+            reason = budget.exhausted()
+            if reason is None:
+                continue
+            # Drop the pending tool calls and answer from what was gathered.
+            history = event["messages"][:-1]
+            break
+
+    if reason is None:
+        return
+
+    log(f"Stopping research for {message_id}: {reason}")
+    separator = _TURN_SEPARATOR if streamed_turn is not None else ""
+    async for chunk in _chat_model().astream(_synthesis_messages(today, history, reason)):
+        delta = _text_delta(chunk.content)
+        if not delta:
+            continue
+        send({
+            "type": "response",
+            "content": separator + delta,
+            "message_id": message_id,
+            "done": False,
+        })
+        separator = ""
+    send({
+        "type": "response",
+        "content": f"\n\n_Research stopped early: {reason}._",
+        "message_id": message_id,
+        "done": False,
+    })
+
+
+async def main():
+    global _OUT
+    # ``python -u`` leaves sys.stdout unbuffered, so give the protocol stream
+    # its own buffer for deferred flushes to coalesce; nothing else may write
+    # to stdout from here on.
+    sys.stdout.flush()
+    _OUT = open(sys.stdout.fileno(), "wb", buffering=16384, closefd=False)
+
     send({"type": "ready"})
     log("Web Research Agent ready")
 
-    for line in sys.stdin:
-        line = line.strip()
+    try:
+        await _serve()
+    finally:
+        await _CLIENT.aclose()
+        _OUT.flush()
+
+
+async def _handle(msg: dict) -> None:
+    mid = msg["message_id"]
+    query = msg["content"]
+
+    async with _SEM:
+        try:
+            await research(query, mid)
+            send({
+                "type": "response",
+                "content": "",
+                "message_id": mid,
+                "done": True,
+            })
+        except Exception as e:
+            log(f"Error: {e}")
+            send({
+                "type": "error",
+                "error": str(e),
+                "message_id": mid,
+            })
+            # Part of the answer may already have been streamed; keep the
+            # error note from running into it.
+            send({
+                "type": "response",
+                "content": f"{_TURN_SEPARATOR}Something went wrong: {e}",
+                "message_id": mid,
+                "done": True,
+            })
+
+
+async def _serve():
+    loop = asyncio.get_running_loop()
+    tasks: set[asyncio.Task] = set()
+
+    while True:
+        # Raw bytes go straight to orjson, skipping the text codec layer.
+        line = await loop.run_in_executor(None, sys.stdin.buffer.readline)
         if not line:
+            break
+        if line.isspace():
             continue
 
         try:
-            msg = json.loads(line)
-        except json.JSONDecodeError:
+            msg = orjson.loads(line)
+        except orjson.JSONDecodeError:
             continue
 
         if msg["type"] == "shutdown":
@@ -143,31 +565,19 @@ def main():
             break
 
         if msg["type"] == "message":
-            mid = msg["message_id"]
-            query = msg["content"]
+            task = asyncio.create_task(_handle(msg))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
 
-            try:
-                result = research(query, mid)
-                send({
-                    "type": "response",
-                    "content": result,
-                    "message_id": mid,
-                    "done": True,
-                })
-            except Exception as e:
-                log(f"Error: {e}")
-                send({
-                    "type": "error",
-                    "error": str(e),
-                    "message_id": mid,
-                })
-                send({
-                    "type": "response",
-                    "content": f"Something went wrong: {e}",
-                    "message_id": mid,
-                    "done": True,
-                })
+    # Let in-flight requests finish before the client is closed.
+    if tasks:
+        await asyncio.gather(*tasks)
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
@@ -0,0 +1,405 @@
+"""Tests for web_search retries, circuit breaker and caches, and research streaming."""
+
+import asyncio
+import json
+import re
+import sys
+from pathlib import Path
+from typing import Any
+
+import httpx
+import pytest
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langgraph.graph import END, START, MessagesState, StateGraph
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import agent  # noqa: E402
+
+OK_BODY = b'{"web": {"results": [{"title": "T", "url": "https://example.com", "description": "D"}]}}'
+
+
+class FakeChatModel(BaseChatModel):
+    """Replays scripted AI messages, streaming their text word by word."""
+
+    responses: Any
+    calls: list = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _next(self, messages) -> AIMessage:
+        self.calls.append(messages)
+        return next(self.responses)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=self._next(messages))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self._next(messages)
+        chunks = [AIMessageChunk(content=word, id=message.id) for word in re.findall(r"\S+\s*", message.content)]
+        chunks.append(AIMessageChunk(
+            content="",
+            id=message.id,
+            tool_call_chunks=[
+                {"name": tc["name"], "args": json.dumps(tc["args"]), "id": tc["id"], "index": i}
+                for i, tc in enumerate(message.tool_calls)
+            ],
+            usage_metadata=message.usage_metadata,
+        ))
+        for chunk in chunks:
+            generation = ChatGenerationChunk(message=chunk)
+            if run_manager:
+                run_manager.on_llm_new_token(generation.text, chunk=generation)
+            yield generation
+
+
+def fake_model(*responses: AIMessage) -> FakeChatModel:
+    return FakeChatModel(responses=iter(responses), calls=[])
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Capture messages research() sends to the client."""
+    messages: list[dict] = []
+    monkeypatch.setattr(agent, "send", messages.append)
+    return messages
+
+
+def response_text(sent: list[dict]) -> str:
+    return "".join(m["content"] for m in sent if m["type"] == "response")
+
+
+@pytest.fixture
+def brave(monkeypatch):
+    """Route Brave calls through a MockTransport and record retry sleeps.
+
+    Set ``brave.responses`` to a list of responses served in order; the last
+    one repeats once the list is exhausted.
+    """
+
+    class Brave:
+        responses: list[httpx.Response] = [httpx.Response(200, content=OK_BODY)]
+        requests: list[httpx.Request] = []
+        sleeps: list[float] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        Brave.requests.append(request)
+        index = min(len(Brave.requests), len(Brave.responses)) - 1
+        return Brave.responses[index]
+
+    async def fake_sleep(seconds: float) -> None:
+        Brave.sleeps.append(seconds)
+
+    monkeypatch.setattr(agent, "_CLIENT", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(agent._brave_get.retry, "sleep", fake_sleep)
+    agent._CACHE.clear()
+    agent._failures.clear()
+    yield Brave
+    agent._CACHE.clear()
+    agent._failures.clear()
+
+
+def search(query: str) -> str:
+    return asyncio.run(agent.web_search.ainvoke({"query": query}))
+
+
+def age(timestamps, seconds: float) -> None:
+    """Shift recorded monotonic timestamps into the past."""
+    for i in range(len(timestamps)):
+        timestamps[i] -= seconds
+
+
+def test_429_waits_for_retry_after(brave):
+    brave.responses = [
+        httpx.Response(429, headers={"Retry-After": "2"}),
+        httpx.Response(200, content=OK_BODY),
+    ]
+    assert "Title: T" in search("rate limited")
+    assert len(brave.requests) == 2
+    assert brave.sleeps == [2.0]
+
+
+def test_429_retry_after_is_capped(brave):
+    brave.responses = [
+        httpx.Response(429, headers={"Retry-After": "60"}),
+        httpx.Response(200, content=OK_BODY),
+    ]
+    search("rate limited")
+    assert brave.sleeps == [agent._MAX_RETRY_AFTER]
+
+
+def test_503_recovers_on_retry(brave):
+    brave.responses = [httpx.Response(503), httpx.Response(200, content=OK_BODY)]
+    assert "Title: T" in search("flaky")
+    assert len(brave.requests) == 2
+    assert len(brave.sleeps) == 1 and 0 < brave.sleeps[0] <= 1.0
+    assert not agent._failures
+
+
+def test_503_gives_up_after_three_attempts(brave):
+    brave.responses = [httpx.Response(503)]
+    assert search("down").startswith("Search error:")
+    assert len(brave.requests) == 3
+    # The breaker counts failed searches, not individual attempts.
+    assert len(agent._failures) == 1
+
+
+def test_401_is_not_retried(brave):
+    brave.responses = [httpx.Response(401)]
+    assert search("unauthorized").startswith("Search error:")
+    assert len(brave.requests) == 1
+    assert brave.sleeps == []
+
+
+def test_breaker_opens_after_repeated_failures_and_closes_after_window(brave):
+    brave.responses = [httpx.Response(401)]
+    for i in range(agent._BREAKER_THRESHOLD + 1):
+        search(f"failing {i}")
+    assert len(brave.requests) == agent._BREAKER_THRESHOLD + 1
+
+    assert "temporarily unavailable" in search("while open")
+    assert len(brave.requests) == agent._BREAKER_THRESHOLD + 1
+
+    age(agent._failures, agent._BREAKER_WINDOW + 1)
+    brave.responses = [httpx.Response(200, content=OK_BODY)]
+    assert "Title: T" in search("after window")
+    assert not agent._failures
+
+
+def test_success_resets_failure_count(brave):
+    brave.responses = [httpx.Response(401)]
+    for i in range(agent._BREAKER_THRESHOLD):
+        search(f"failing {i}")
+    brave.responses = [httpx.Response(200, content=OK_BODY)]
+    search("ok")
+    assert not agent._failures
+
+
+def test_cache_serves_repeat_queries(brave):
+    search("Python  ")
+    search("python")
+    assert len(brave.requests) == 1
+
+
+def test_cache_expires_after_ttl(brave):
+    search("python")
+    stored_at, result = agent._CACHE["python"]
+    agent._CACHE["python"] = (stored_at - agent._CACHE_TTL - 1, result)
+    search("python")
+    assert len(brave.requests) == 2
+
+
+def test_cache_evicts_least_recently_used(brave, monkeypatch):
+    monkeypatch.setattr(agent, "_CACHE_MAX_ENTRIES", 2)
+    search("a")
+    search("b")
+    search("a")
+    search("c")
+    assert list(agent._CACHE) == ["a", "c"]
+
+
+def test_errors_are_not_cached(brave):
+    brave.responses = [httpx.Response(401)]
+    search("python")
+    assert not agent._CACHE
+
+
+def test_fingerprint_ignores_order_case_and_stopwords():
+    assert agent._fingerprint("Rust async runtimes") == agent._fingerprint("the async runtimes of rust")
+    assert agent._fingerprint("rust benchmarks") != agent._fingerprint("rust benchmark results")
+
+
+def test_run_cache_deduplicates_paraphrases_within_a_run(brave):
+    async def run():
+        agent._run_cache.set({})
+        first = await agent.web_search.ainvoke({"query": "async Rust runtimes"})
+        second = await agent.web_search.ainvoke({"query": "runtimes for rust async"})
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == second
+    assert len(brave.requests) == 1
+
+
+def test_research_streams_only_model_node_text_with_turn_separators(monkeypatch, sent):
+    model = fake_model(
+        AIMessage("Looking it up.", id="turn-1", tool_calls=[{"name": "lookup", "args": {}, "id": "call-1"}]),
+        AIMessage("Final answer.", id="turn-2"),
+    )
+    helper = fake_model(*(AIMessage("internal summary", id=f"helper-{i}") for i in range(2)))
+
+    async def summarize(state):
+        await helper.ainvoke(state["messages"])
+        return {}
+
+    async def call_model(state):
+        return {"messages": [await model.ainvoke(state["messages"])]}
+
+    def tools(state):
+        return {"messages": [ToolMessage("done", name="lookup", tool_call_id="call-1")]}
+
+    graph = StateGraph(MessagesState)
+    graph.add_node("summarize", summarize)
+    graph.add_node("model", call_model)
+    graph.add_node("tools", tools)
+    graph.add_edge(START, "summarize")
+    graph.add_edge("summarize", "model")
+    graph.add_conditional_edges("model", lambda s: "tools" if s["messages"][-1].tool_calls else END)
+    graph.add_edge("tools", "summarize")
+    monkeypatch.setattr(agent, "_build_agent", lambda today: graph.compile())
+
+    asyncio.run(agent.research("question", "mid"))
+
+    assert response_text(sent) == f"Looking it up.{agent._TURN_SEPARATOR}Final answer."
+    assert all(m["message_id"] == "mid" for m in sent)
+
+
+def test_every_search_reports_start_and_completion(brave, sent):
+    brave.responses = [httpx.Response(200, content=OK_BODY), httpx.Response(401)]
+
+    async def run():
+        agent._current_message_id.set("mid")
+        agent._run_cache.set({})
+        await agent.web_search.ainvoke({"query": "rust"})
+        await agent.web_search.ainvoke({"query": "go"})
+        await agent.web_search.ainvoke({"query": "Rust"})
+
+    asyncio.run(run())
+    assert [m["description"] for m in sent] == [
+        "web_search(rust)",
+        "Analyzing results: rust",
+        "web_search(go)",
+        "Search failed: go",
+        "web_search(Rust)",
+        "Analyzing results: Rust",
+    ]
+
+
+def search_turn(i: int, *queries: str, output_tokens: int = 10) -> AIMessage:
+    return AIMessage(
+        f"Searching {i}.",
+        id=f"turn-{i}",
+        tool_calls=[
+            {"name": "web_search", "args": {"query": q}, "id": f"call-{i}-{j}"}
+            for j, q in enumerate(queries)
+        ],
+        usage_metadata={"input_tokens": 1, "output_tokens": output_tokens, "total_tokens": output_tokens + 1},
+    )
+
+
+@pytest.fixture
+def deep_agent(monkeypatch, brave):
+    """Run research() on a real Deep Agent driven by scripted model turns.
+
+    Returns a function taking the agent's turns; it returns the fake model
+    used for the budget-exhausted synthesis call.
+    """
+    from deepagents import create_deep_agent
+
+    def setup(*turns: AIMessage) -> FakeChatModel:
+        model = fake_model(*turns)
+        synthesis = fake_model(AIMessage("Synthesized answer.", id="synthesis"))
+        monkeypatch.setattr(agent, "_build_agent", lambda today: create_deep_agent(
+            model=model, tools=[agent.web_search], system_prompt="sys",
+        ))
+        monkeypatch.setattr(agent, "_chat_model", lambda: synthesis)
+        return synthesis
+
+    return setup
+
+
+def test_turn_limit_stops_and_answers_from_gathered_results(monkeypatch, deep_agent, brave, sent):
+    monkeypatch.setattr(agent, "_MAX_TURNS", 2)
+    synthesis = deep_agent(search_turn(0, "rust"), search_turn(1, "go"), search_turn(2, "zig"))
+
+    asyncio.run(agent.research("question", "mid"))
+
+    assert len(brave.requests) == 1
+    assert len(synthesis.calls) == 1
+    text = response_text(sent)
+    assert text.endswith(
+        f"{agent._TURN_SEPARATOR}Synthesized answer."
+        "\n\n_Research stopped early: reached the limit of 2 model turns._"
+    )
+    assert "web_search(go)" not in [m.get("description") for m in sent]
+
+
+def test_token_limit_stops_before_running_tools(monkeypatch, deep_agent, brave, sent):
+    monkeypatch.setattr(agent, "_MAX_OUTPUT_TOKENS", 50)
+    synthesis = deep_agent(search_turn(0, "rust", output_tokens=60))
+
+    asyncio.run(agent.research("question", "mid"))
+
+    assert brave.requests == []
+    assert len(synthesis.calls) == 1
+    assert response_text(sent).endswith("_Research stopped early: used over 50 response tokens._")
+
+
+def test_repeated_searches_stop_the_run(monkeypatch, deep_agent, brave, sent):
+    monkeypatch.setattr(agent, "_MAX_DUPLICATE_SEARCHES", 0)
+    synthesis = deep_agent(search_turn(0, "rust"), search_turn(1, "Rust"), search_turn(2, "go"))
+
+    asyncio.run(agent.research("question", "mid"))
+
+    assert len(brave.requests) == 1
+    assert len(synthesis.calls) == 1
+    assert response_text(sent).endswith("_Research stopped early: kept repeating earlier searches._")
+
+
+def test_subagent_usage_counts_against_the_budget(monkeypatch, deep_agent, brave, sent):
+    monkeypatch.setattr(agent, "_MAX_TURNS", 3)
+    delegate = AIMessage(
+        "Delegating.",
+        id="main-0",
+        tool_calls=[{
+            "name": "task",
+            "args": {"description": "research it", "subagent_type": "general-purpose"},
+            "id": "call-task",
+        }],
+    )
+    synthesis = deep_agent(
+        delegate,
+        search_turn(1, "rust"),  # subagent
+        search_turn(2, "go"),  # subagent, over budget
+        AIMessage("Subagent done.", id="sub-done"),
+        search_turn(4, "zig"),  # main agent
+    )
+
+    asyncio.run(agent.research("question", "mid"))
+
+    descriptions = [m["description"] for m in sent if m["type"] == "activity"]
+    assert "Analyzing results: rust" in descriptions
+    assert "Skipped: go" in descriptions
+    assert "web_search(zig)" not in descriptions
+    assert len(brave.requests) == 1
+    assert len(synthesis.calls) == 1
+
+
+def test_synthesis_messages_flatten_tool_traffic():
+    history = [
+        HumanMessage("question"),
+        AIMessage("", tool_calls=[{"name": "web_search", "args": {"query": "q"}, "id": "c1"}]),
+        ToolMessage("Title: T", name="web_search", tool_call_id="c1"),
+        AIMessage([{"type": "text", "text": "Interim."}, {"type": "tool_use", "id": "c2", "name": "x", "input": {}}]),
+        ToolMessage("anonymous", tool_call_id="c2"),
+    ]
+
+    messages = agent._synthesis_messages("today", history, "kept repeating earlier searches")
+
+    assert [(type(m), m.content) for m in messages] == [
+        (SystemMessage, agent._system_prompt("today")),
+        (HumanMessage, "question"),
+        (HumanMessage, "[web_search result]\nTitle: T"),
+        (AIMessage, "Interim."),
+        (HumanMessage, "[tool result]\nanonymous"),
+        (HumanMessage,
+         "Research has stopped because it kept repeating earlier searches. Do not search "
+         "further: answer the original question now from the results gathered above."),
+    ]